@@ -0,0 +1,117 @@
+"""Benchmark for history_table.analytics on a synthetic history table.
+
+Builds an SQLite file with a multi-million-row history table (a few hot rows
+edited constantly, a long tail edited rarely), then times a full streaming
+change_statistics() pass. Max RSS is reported to show that memory is bounded
+by the chunk size rather than the table size.
+
+    python examples/analytics_benchmark.py --rows 5000000 --chunk-size 200000
+"""
+
+import argparse
+import datetime
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+from sqlalchemy import create_engine, Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+import history_table.history_table as ht
+from history_table import analytics
+
+Base = declarative_base()
+
+class Counter(Base, ht.Versioned):
+    __tablename__ = 'counter'
+
+    id = Column(Integer, primary_key = True)
+    status = Column(String)
+    hits = Column(Integer)
+
+def populate(engine, n_rows, n_keys, days=30, seed=0):
+    '''Inserts n_rows synthetic history rows spread over n_keys primary keys
+    with a Zipf-like skew, so a handful of keys hold most of the versions.
+
+    Each key is edited on its own clock over the same `days` long period, at
+    a rate proportional to its weight: hot keys every few seconds, tail keys
+    days or weeks apart.'''
+
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, n_keys + 1)
+    p = weights / weights.sum()
+    keys = rng.choice(n_keys, size=n_rows, p=p) + 1
+    keys.sort(kind="stable")
+
+    #version numbers restart at 1 for every key
+    starts = np.flatnonzero(np.diff(keys, prepend=0))
+    run_lengths = np.diff(np.append(starts, n_rows))
+    versions = np.arange(n_rows) - np.repeat(starts, run_lengths) + 1
+
+    #exponential gaps with a per-key mean, summed within each key's run
+    mean_gap = days * 86400.0 / (p[keys - 1] * n_rows)
+    gaps = rng.exponential(mean_gap)
+    total = gaps.cumsum()
+    offsets = total - np.repeat(total[starts] - gaps[starts], run_lengths)
+
+    start = datetime.datetime(2020, 1, 1)
+    statuses = np.array(['new', 'open', 'closed'])[rng.integers(0, 3, n_rows)]
+
+    history = Counter.__history_mapper__.local_table
+    batch = 100000
+    with engine.begin() as conn:
+        for lo in range(0, n_rows, batch):
+            hi = min(lo + batch, n_rows)
+            conn.execute(history.insert(), [
+                {
+                    "id": int(keys[i]),
+                    "version": int(versions[i]),
+                    "status": str(statuses[i]),
+                    "hits": int(versions[i]) // 3,
+                    "changed": start + datetime.timedelta(seconds=float(offsets[i])),
+                }
+                for i in range(lo, hi)
+            ])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--keys", type=int, default=100000)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(), "history_bench.sqlite")
+    engine = create_engine("sqlite:///" + path)
+    Base.metadata.create_all(engine)
+
+    t0 = time.perf_counter()
+    populate(engine, args.rows, args.keys)
+    print("populated %d rows in %.1fs" % (args.rows, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    with engine.connect() as conn:
+        stats = analytics.change_statistics(
+            conn, Counter, chunk_size=args.chunk_size,
+            hot_interval=datetime.timedelta(hours=1),
+        )
+    elapsed = time.perf_counter() - t0
+    #ru_maxrss is in KiB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print("analyzed %d rows in %.1fs (%.0f rows/s), max RSS %.1f MiB" % (
+        stats.rows, elapsed, stats.rows / elapsed, peak / 2**10))
+    print("column changes:", stats.column_changes)
+    print("interval histogram:")
+    for lo, hi, count in zip(stats.interval_edges, stats.interval_edges[1:],
+                             stats.interval_counts):
+        print("  %10gs - %-10gs %d" % (lo, hi, count))
+    print("hot keys per hour:")
+    for key, count in stats.hot_keys():
+        print("  ", key, count)
+
+    os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""Vectorized change statistics over history tables.
+
+History rows are streamed from the database in fixed-size chunks ordered by
+primary key and version. Each chunk is turned into one NumPy array per column
+so that change counts, edit intervals and hot keys are computed with array
+operations rather than by iterating <Model>History objects. Only the current
+chunk and the last row of the previous one are held in memory.
+"""
+
+from itertools import islice
+
+import numpy as np
+from sqlalchemy import select
+
+from history_table.history_table import _is_versioning_col
+from history_table.tiering import history_rows
+
+#upper edges (in seconds) of the default inter-edit interval histogram:
+#second, ten seconds, minute, ten minutes, hour, day, week, month, year
+DEFAULT_INTERVAL_BINS = np.array(
+    [0, 1, 10, 60, 600, 3600, 86400, 604800, 2592000, 31536000, np.inf]
+)
+
+def _history_table(cls):
+    return cls.__history_mapper__.local_table
+
+def _key_columns(table):
+    '''Primary key columns of a history table, minus the version column.'''
+
+    return [c for c in table.primary_key.columns if not _is_versioning_col(c)]
+
+def _column_array(values):
+    try:
+        arr = np.array(values)
+    except ValueError:
+        arr = None
+
+    #ragged or nested values (e.g. JSON lists) fall back to a flat object array
+    if arr is None or arr.ndim != 1:
+        arr = np.empty(len(values), dtype=object)
+        arr[:] = values
+
+    return arr
+
+def _to_arrays(keys, rows):
+    columns = list(zip(*rows)) if rows else [()] * len(keys)
+    arrays = {}
+
+    for key, values in zip(keys, columns):
+        if key == "changed":
+            arrays[key] = np.array(values, dtype="datetime64[us]")
+        else:
+            arrays[key] = _column_array(values)
+
+    return arrays
+
+def _tiered_partitions(connection, cls, store, cols, chunk_size):
+    all_keys = [c.key for c in _history_table(cls).c]
+    idx = [all_keys.index(c.key) for c in cols]
+    rows = history_rows(connection, cls, store)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield [tuple(row[i] for i in idx) for row in chunk]
+
+def iter_history_chunks(connection, cls, chunk_size=100000, columns=None,
+                        store=None):
+    '''Streams the history table of Versioned class `cls`, yielding a dict of
+    column key -> numpy array per chunk of at most `chunk_size` rows.
+
+    Rows are ordered by primary key then version, so all versions of a given
+    row are adjacent (possibly straddling a chunk boundary). `columns` limits
+    the value columns fetched; key columns, "version" and "changed" are always
+    included. Rows archived to tiering.ColdStore `store`, if given, are
+    merged in.
+    '''
+
+    table = _history_table(cls)
+    key_cols = _key_columns(table)
+
+    if columns is None:
+        cols = list(table.c)
+    else:
+        wanted = set(columns) | {c.key for c in key_cols}
+        wanted |= {"version", "changed"}
+        cols = [c for c in table.c if c.key in wanted]
+
+    keys = [c.key for c in cols]
+
+    if store is not None:
+        partitions = _tiered_partitions(
+            connection, cls, store, cols, chunk_size
+        )
+    else:
+        stmt = select(*cols).order_by(*key_cols, table.c.version)
+        result = connection.execution_options(stream_results=True).execute(stmt)
+        partitions = result.partitions(chunk_size)
+
+    for rows in partitions:
+        yield _to_arrays(keys, rows)
+
+def _not_equal(a, b):
+    neq = np.asarray(a != b, dtype=bool)
+
+    #NaN never equals itself; don't count NaN -> NaN as a change
+    if a.dtype.kind == "f":
+        neq &= ~(np.isnan(a) & np.isnan(b))
+
+    return neq
+
+def _item(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+class ChangeStatistics:
+    '''Accumulator for change statistics over a stream of history chunks, as
+    produced by iter_history_chunks().
+
+    Statistics are over consecutive history rows of the same primary key, i.e.
+    the transition from the last history row to the live row is not counted.
+
+    `bins` are the inter-edit interval histogram edges, in seconds. `top` is
+    the number of hot keys retained. If `hot_interval` (a timedelta) is given,
+    hot keys are counted per (primary key, interval bucket) instead of per
+    primary key, e.g. to find the hottest rows per hour.
+    '''
+
+    def __init__(self, key_names, value_names, bins=DEFAULT_INTERVAL_BINS,
+                 top=10, hot_interval=None):
+        self.key_names = list(key_names)
+        self.value_names = list(value_names)
+        self.interval_edges = np.asarray(bins, dtype=float)
+        self.interval_counts = np.zeros(len(self.interval_edges) - 1, np.int64)
+        self.column_changes = dict.fromkeys(self.value_names, 0)
+        self.rows = 0
+        self.top = top
+
+        if hot_interval is not None:
+            hot_interval = np.timedelta64(hot_interval, "us").astype(np.int64)
+        self.hot_interval = hot_interval
+
+        #last row of the previous chunk, and the still-open hot key run
+        self._carry = None
+        self._open_key = None
+        self._open_count = 0
+        self._top = []
+
+    def _run_keys(self, chunk):
+        keys = [chunk[k] for k in self.key_names]
+
+        if self.hot_interval is not None:
+            us = chunk["changed"].astype(np.int64)
+            buckets = (us // self.hot_interval) * self.hot_interval
+            keys.append(buckets.astype("datetime64[us]"))
+
+        return keys
+
+    def update(self, chunk):
+        n_new = len(chunk["version"])
+        if n_new == 0:
+            return
+
+        self.rows += n_new
+
+        if self._carry is not None:
+            chunk = {
+                k: np.concatenate((self._carry[k], v)) for k, v in chunk.items()
+            }
+        self._carry = {k: v[-1:] for k, v in chunk.items()}
+
+        n = len(chunk["version"])
+        same_key = np.ones(n - 1, dtype=bool)
+        for k in self.key_names:
+            same_key &= ~_not_equal(chunk[k][1:], chunk[k][:-1])
+
+        for k in self.value_names:
+            arr = chunk[k]
+            changed = _not_equal(arr[1:], arr[:-1]) & same_key
+            self.column_changes[k] += int(np.count_nonzero(changed))
+
+        changed_at = chunk["changed"]
+        gaps = (changed_at[1:] - changed_at[:-1])[same_key]
+        gaps = gaps[~np.isnat(gaps)] / np.timedelta64(1, "s")
+        self.interval_counts += np.histogram(gaps, self.interval_edges)[0]
+
+        self._update_hot_keys(chunk, n_new < n)
+
+    def _update_hot_keys(self, chunk, carried):
+        run_keys = self._run_keys(chunk)
+        n = len(run_keys[0])
+
+        same_run = np.ones(n - 1, dtype=bool)
+        for arr in run_keys:
+            same_run &= ~_not_equal(arr[1:], arr[:-1])
+
+        starts = np.concatenate(([0], np.flatnonzero(~same_run) + 1))
+        counts = np.diff(np.append(starts, n))
+
+        #first run continues the open run; its carried row was already counted
+        if carried:
+            counts[0] += self._open_count - 1
+
+        self._open_key = tuple(_item(arr[starts[-1]]) for arr in run_keys)
+        self._open_count = int(counts[-1])
+
+        closed = counts[:-1]
+        if len(closed) > self.top:
+            closed_idx = np.argpartition(closed, -self.top)[-self.top:]
+        else:
+            closed_idx = np.arange(len(closed))
+
+        candidates = self._top + [
+            (tuple(_item(arr[starts[i]]) for arr in run_keys), int(closed[i]))
+            for i in closed_idx
+        ]
+        self._top = sorted(candidates, key=lambda kc: -kc[1])[:self.top]
+
+    def hot_keys(self):
+        '''Returns up to `top` (key, count) pairs, most edited first. Keys are
+        primary key tuples, with the interval bucket start appended when
+        hot_interval is set.'''
+
+        candidates = list(self._top)
+        if self._open_key is not None:
+            candidates.append((self._open_key, self._open_count))
+
+        return sorted(candidates, key=lambda kc: -kc[1])[:self.top]
+
+
+def change_statistics(connection, cls, chunk_size=100000,
+                      bins=DEFAULT_INTERVAL_BINS, top=10, hot_interval=None,
+                      columns=None, store=None):
+    '''Computes ChangeStatistics for the history table of Versioned class
+    `cls` in a single streaming pass of at most `chunk_size` rows at a time.
+    '''
+
+    table = _history_table(cls)
+    key_names = [c.key for c in _key_columns(table)]
+    value_names = [
+        c.key for c in table.c
+        if not _is_versioning_col(c)
+        and c.key not in key_names
+        and (columns is None or c.key in columns)
+    ]
+
+    stats = ChangeStatistics(key_names, value_names, bins, top, hot_interval)
+    chunks = iter_history_chunks(connection, cls, chunk_size, columns, store)
+    for chunk in chunks:
+        stats.update(chunk)
+
+    return stats
@@ -0,0 +1,318 @@
+"""Loading object graphs as they were at a point in time.
+
+The history row of version N holds the state a row had until the change that
+created version N + 1, at time "changed". So the state of a row as of time T
+is its lowest history version changed after T, or the live row if there is
+none. load_asof() resolves that for a set of root rows and then for each level
+of the given relationship paths, much like selectinload: each level costs one
+batched query against the related history table plus one against its live
+table, however many objects are involved.
+
+Snapshots are instances of the <Model>History classes, detached, with the
+loaded relationships set as plain attributes. They are read through a session
+of their own on the caller's connection, so they are never the instances in
+the caller's session, and reflect the rows in the database: flushed changes
+are included, unflushed ones aren't.
+
+Creation times aren't recorded, so a row created after T is returned in its
+first version rather than omitted.
+
+Given a tiering.ColdStore, archived history rows are taken into account too.
+Only cold partitions holding rows changed after T are read, so loading recent
+states never touches cold storage. Joined table inheritance isn't supported
+with a store.
+"""
+
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import tuple_
+from sqlalchemy import union
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.orm import object_mapper
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import with_polymorphic
+
+#maximum number of values in a single IN clause
+IN_BATCH_SIZE = 500
+
+def _attr_keys(mapper, cols):
+    return [mapper.get_property_by_column(c).key for c in cols]
+
+def _in(attrs, values):
+    if len(attrs) == 1:
+        if isinstance(values, list):
+            values = [v[0] for v in values]
+        return attrs[0].in_(values)
+
+    return tuple_(*attrs).in_(values)
+
+def _snapshot_from_live(obj):
+    '''Copies a live object into a transient instance of its history class.'''
+
+    mapper = object_mapper(obj)
+    history_mapper = obj.__history_mapper__
+    snapshot = history_mapper.class_()
+
+    for prop in history_mapper.column_attrs:
+        if prop.key in mapper.column_attrs:
+            setattr(snapshot, prop.key, getattr(obj, prop.key))
+
+    return snapshot
+
+def _snapshot_from_row(history_mapper, row):
+    '''Builds a transient history instance from a cold history table row.'''
+
+    snapshot = history_mapper.class_()
+    for prop in history_mapper.column_attrs:
+        setattr(snapshot, prop.key, row._mapping[prop.columns[0].name])
+
+    return snapshot
+
+def _cold_table(history_mapper, store, as_of):
+    '''Returns the history table to read from cold storage, or None if it
+    has no cold partitions holding rows changed after as_of.'''
+
+    table = history_mapper.local_table
+    if store is None or not store.partitions(table, since=as_of):
+        return None
+
+    return table
+
+def _check_cold_support(cls, tree):
+    '''Raises ValueError if `cls` or a class on the relationship paths `tree`
+    is mapped with joined table inheritance, whose archived rows are split
+    across cold tables.'''
+
+    history_mapper = getattr(cls, "__history_mapper__", None)
+    if history_mapper is not None:
+        hierarchy = history_mapper.base_mapper.self_and_descendants
+        if len({m.local_table for m in hierarchy}) > 1:
+            raise ValueError(
+                "%s: as-of loading from cold storage isn't supported for "
+                "joined table inheritance" % cls.__name__
+            )
+
+    mapper = class_mapper(cls)
+    for key, subtree in tree.items():
+        _check_cold_support(mapper.relationships[key].mapper.class_, subtree)
+
+def _column_names(history_mapper, keys):
+    return [history_mapper.get_property(k).columns[0].name for k in keys]
+
+def _cold_rows(history_mapper, store, table, keys, values, as_of):
+    cols = _column_names(history_mapper, keys)
+
+    def where(cold):
+        return and_(
+            cold.c.changed > as_of, _in([cold.c[c] for c in cols], values)
+        )
+
+    for rows in store.rows(table, where, since=as_of):
+        yield from rows
+
+def _load_batch(session, cls, crit_keys, values, as_of, store=None):
+    mapper = class_mapper(cls)
+    history_mapper = cls.__history_mapper__
+    history_cls = history_mapper.class_
+    pk_keys = _attr_keys(mapper, mapper.primary_key)
+    hist_pk = [getattr(history_cls, k) for k in pk_keys]
+    live_pk = [getattr(cls, k) for k in pk_keys]
+
+    #any row whose as-of state matches has a matching live row, or history row
+    #changed after as_of
+    if crit_keys == pk_keys:
+        candidates = values
+    else:
+        candidates = union(
+            select(*hist_pk).select_from(history_cls).where(
+                history_cls.changed > as_of,
+                _in([getattr(history_cls, k) for k in crit_keys], values),
+            ),
+            select(*live_pk).select_from(cls).where(
+                _in([getattr(cls, k) for k in crit_keys], values)
+            ),
+        )
+
+    #archived rows are older than any in the hot table, so a cold row changed
+    #after as_of is always the as-of state of its row
+    snapshots = []
+    cold_table = _cold_table(history_mapper, store, as_of)
+    if cold_table is not None:
+        pk_names = _column_names(history_mapper, pk_keys)
+
+        if not isinstance(candidates, list):
+            keys = {tuple(k) for k in session.execute(candidates)}
+            keys.update(
+                tuple(row._mapping[c] for c in pk_names)
+                for row in _cold_rows(
+                    history_mapper, store, cold_table, crit_keys, values,
+                    as_of,
+                )
+            )
+            candidates = list(keys)
+
+        cold_first = {}
+        for row in _cold_rows(
+            history_mapper, store, cold_table, pk_keys, candidates, as_of
+        ):
+            key = tuple(row._mapping[c] for c in pk_names)
+            if key not in cold_first or row.version < cold_first[key].version:
+                cold_first[key] = row
+
+        snapshots = [
+            _snapshot_from_row(history_mapper, row)
+            for row in cold_first.values()
+        ]
+        candidates = [k for k in candidates if k not in cold_first]
+        if not candidates:
+            return _matching(snapshots, crit_keys, values)
+
+    first = (
+        select(
+            *(a.label(k) for a, k in zip(hist_pk, pk_keys)),
+            func.min(history_cls.version).label("version"),
+        )
+        .select_from(history_cls)
+        .where(history_cls.changed > as_of, _in(hist_pk, candidates))
+        .group_by(*hist_pk)
+        .subquery()
+    )
+
+    #load subclass columns up front; snapshots can't lazy load once detached
+    history_poly = with_polymorphic(history_cls, "*")
+    history = (
+        session.query(history_poly)
+        .join(first, and_(
+            history_poly.version == first.c.version,
+            *(getattr(history_poly, k) == first.c[k] for k in pk_keys)
+        ))
+        .all()
+    )
+
+    live_poly = with_polymorphic(cls, "*")
+    live = (
+        session.query(live_poly)
+        .filter(_in([getattr(live_poly, k) for k in pk_keys], candidates))
+        .all()
+    )
+
+    found = {tuple(getattr(s, k) for k in pk_keys) for s in history}
+    snapshots += history + [
+        _snapshot_from_live(obj) for obj in live
+        if tuple(getattr(obj, k) for k in pk_keys) not in found
+    ]
+
+    return _matching(snapshots, crit_keys, values)
+
+def _matching(snapshots, crit_keys, values):
+    values = set(values)
+    return [
+        s for s in snapshots
+        if tuple(getattr(s, k) for k in crit_keys) in values
+    ]
+
+def _load(session, cls, crit_keys, values, as_of, store=None):
+    '''Returns snapshots of the rows of `cls` whose as-of state has the
+    attributes `crit_keys` equal to one of the tuples in `values`.'''
+
+    if not hasattr(cls, "__history_mapper__"):
+        raise ValueError("%s is not a Versioned class" % cls.__name__)
+
+    values = list(values)
+    snapshots = []
+
+    for i in range(0, len(values), IN_BATCH_SIZE):
+        batch = values[i:i + IN_BATCH_SIZE]
+        snapshots += _load_batch(session, cls, crit_keys, batch, as_of, store)
+
+    return snapshots
+
+def _path_tree(paths):
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path.split("."):
+            node = node.setdefault(key, {})
+    return tree
+
+def _load_relationships(session, cls, snapshots, tree, as_of, store=None):
+    mapper = class_mapper(cls)
+
+    for key, subtree in tree.items():
+        prop = mapper.relationships[key]
+        if prop.secondary is not None:
+            raise NotImplementedError(
+                "%s.%s: relationships through a secondary table can't be "
+                "loaded as of a time, as the secondary table isn't versioned"
+                % (cls.__name__, key)
+            )
+
+        target = prop.mapper.class_
+        local_cols, remote_cols = zip(*prop.local_remote_pairs)
+        local_keys = _attr_keys(mapper, local_cols)
+        remote_keys = _attr_keys(prop.mapper, remote_cols)
+
+        parent_values = {
+            s: tuple(getattr(s, k) for k in local_keys) for s in snapshots
+        }
+        values = {v for v in parent_values.values() if None not in v}
+        related = _load(session, target, remote_keys, values, as_of, store)
+
+        by_value = {}
+        for r in related:
+            by_value.setdefault(
+                tuple(getattr(r, k) for k in remote_keys), []
+            ).append(r)
+
+        for s, value in parent_values.items():
+            matches = by_value.get(value, [])
+            if prop.uselist:
+                setattr(s, key, list(matches))
+            else:
+                setattr(s, key, matches[0] if matches else None)
+
+        if subtree:
+            _load_relationships(
+                session, target, related, subtree, as_of, store
+            )
+
+def load_asof(session, cls, keys, as_of, paths=(), store=None):
+    '''Returns detached snapshots of the rows of Versioned class `cls` with
+    primary keys `keys` as they were at `as_of`, a naive UTC datetime like the
+    history "changed" column. Rows that no longer existed are omitted.
+
+    `paths` are dotted relationship paths of the live mappers, e.g.
+    ("lines.product", "customer"), whose targets must also be Versioned.
+    Each is loaded as of the same time and set on the snapshots under the
+    relationship's name, as a list or a single snapshot (or None).
+    Relationships through a secondary table aren't supported.
+
+    If `store` is given, history rows archived to that tiering.ColdStore are
+    included. A ValueError is raised if any of the classes loaded is mapped
+    with joined table inheritance.
+    '''
+
+    mapper = class_mapper(cls)
+    pk_keys = _attr_keys(mapper, mapper.primary_key)
+    keys = [k if isinstance(k, tuple) else (k,) for k in keys]
+
+    tree = _path_tree(paths)
+    if store is not None:
+        _check_cold_support(cls, tree)
+
+    #the reader's identity map starts empty, and closing it detaches the
+    #snapshots without affecting the caller's transaction
+    reader = Session(
+        bind=session.connection(bind_arguments={"mapper": mapper}),
+        autoflush=False,
+    )
+    try:
+        snapshots = _load(reader, cls, pk_keys, set(keys), as_of, store)
+        _load_relationships(reader, cls, snapshots, tree, as_of, store)
+    finally:
+        reader.close()
+
+    by_key = {tuple(getattr(s, k) for k in pk_keys): s for s in snapshots}
+
+    return [by_key[k] for k in keys if k in by_key]
@@ -7,12 +7,17 @@ Minor modifications made by me as noted with comments
 """
 
 import datetime
+import logging
+import queue
+import threading
+from collections import namedtuple
 
 from sqlalchemy import Column
 from sqlalchemy import DateTime
 from sqlalchemy import event
 from sqlalchemy import ForeignKeyConstraint
 from sqlalchemy import Integer
+from sqlalchemy import select
 from sqlalchemy import Table
 from sqlalchemy import String
 from sqlalchemy import util
@@ -24,6 +29,8 @@ from sqlalchemy.orm import object_mapper
 from sqlalchemy.orm.exc import UnmappedColumnError
 from sqlalchemy.orm.relationships import RelationshipProperty
 
+log = logging.getLogger(__name__)
+
 def col_references_table(col, table):
     for fk in col.foreign_keys:
         if fk.references(table):
@@ -36,6 +43,17 @@ def _is_versioning_col(col):
 def _history_mapper(local_mapper):
     cls = local_mapper.class_
 
+    #the mapper bumps version_id_col on every UPDATE, so a coalesced change
+    #would skip a version number and leave a gap in the history
+    if cls.use_mapper_versioning and (
+        cls.coalesce_version_seconds is not None
+        or cls.coalesce_version_transaction
+    ):
+        raise ValueError(
+            "%s: use_mapper_versioning can't be combined with version "
+            "coalescing" % cls.__name__
+        )
+
     # set the "active_history" flag
     # on on column-mapped attributes so that the old version
     # of the info is always loaded (currently sets it on all attributes)
@@ -202,6 +220,22 @@ class Versioned:
     include_version_timestamp = True
     include_version_message = False
     
+    #write coalescing for rows updated many times in quick succession. A
+    #coalesced change is folded into the row's current version: no history
+    #row is written and the version number is not bumped, so history stays
+    #gapless and always holds the state each version had when it was
+    #superseded. Only intermediate states are lost. Deletes always write a
+    #history row.
+    coalesce_version_seconds = None
+    """if set, changes made less than this many seconds after the row's
+    current version began are coalesced. Not compatible with
+    use_mapper_versioning."""
+
+    coalesce_version_transaction = False
+    """if True, at most one history row is written per row per transaction
+    (changeset); it holds the state from before the transaction. Not
+    compatible with use_mapper_versioning."""
+
     __table_args__ = {"sqlite_autoincrement": True}
     """Use sqlite_autoincrement, to ensure unique integer values
     are used for new rows even for rows that have been deleted."""
@@ -230,6 +264,65 @@ def versioned_objects(iter_):
             yield obj
 
 
+#session.info key for the objects versioned in the current transaction, mapped
+#to the (sub)transaction that wrote their history row
+_TXN_VERSIONED = "history_table_versioned"
+
+#session.info key for the changes recorded in the current transaction, along
+#with the (sub)transaction that recorded them
+_TXN_CHANGES = "history_table_changes"
+
+def _savepoint(session):
+    return session.get_nested_transaction() or session.get_transaction()
+
+def _rolled_back(transaction, boundary):
+    while transaction is not None:
+        if transaction is boundary:
+            return True
+        transaction = transaction.parent
+    return False
+
+def _coalesce_version(obj, session):
+    '''Returns True if a change to obj should be folded into its current
+    version according to its class's coalescing policy.
+    '''
+
+    state = attributes.instance_state(obj)
+    if (
+        obj.coalesce_version_transaction
+        and state in session.info.get(_TXN_VERSIONED, ())
+    ):
+        return True
+
+    window = obj.coalesce_version_seconds
+    if window is None or obj.version <= 1:
+        return False
+
+    #the current version began when the history row of the previous one was
+    #written. That time is kept on the instance when this process writes the
+    #row; otherwise look it up by primary key
+    version, began = getattr(obj, "_version_began", (None, None))
+    if version != obj.version:
+        base_mapper = object_mapper(obj).base_mapper
+        hist_table = obj.__history_mapper__.base_mapper.local_table
+        pk = base_mapper.primary_key_from_instance(obj)
+
+        stmt = select(hist_table.c.changed).where(
+            hist_table.c.version == obj.version - 1,
+            *(
+                hist_table.c[col.key] == value
+                for col, value in zip(base_mapper.primary_key, pk)
+            )
+        )
+        began = session.execute(stmt).scalar()
+        obj._version_began = (obj.version, began)
+
+    return (
+        began is not None
+        and datetime.datetime.utcnow() - began
+        < datetime.timedelta(seconds=window)
+    )
+
 def create_version(obj, session, deleted=False):
     obj_mapper = object_mapper(obj)
     history_mapper = obj.__history_mapper__
@@ -240,6 +333,7 @@ def create_version(obj, session, deleted=False):
     attr = {}
 
     obj_changed = False
+    changed_keys = []
 
     for om, hm in zip(
         obj_mapper.iterate_to_root(), history_mapper.iterate_to_root()
@@ -278,12 +372,14 @@ def create_version(obj, session, deleted=False):
             if d:
                 attr[prop.key] = d[0]
                 obj_changed = True
+                changed_keys.append(prop.key)
             elif u:
                 attr[prop.key] = u[0]
             elif a:
                 # if the attribute had no value.
                 attr[prop.key] = a[0]
                 obj_changed = True
+                changed_keys.append(prop.key)
 
     if not obj_changed:
         # not changed, but we have relationships.  OK
@@ -300,16 +396,25 @@ def create_version(obj, session, deleted=False):
                         obj_changed = True
                         break
                 if obj_changed is True:
+                    changed_keys.append(prop.key)
                     break
 
     if not obj_changed and not deleted:
         return
     
+    #any pending version message is kept for the next history row written
+    if not deleted and _coalesce_version(obj, session):
+        _record_change(session, obj, obj.version, obj.version, changed_keys)
+        return
+
     if obj.include_version_message is True:
         attr["version_message"] = getattr(obj, "version_message", '')
         setattr(obj, "version_message", '')
 
     attr["version"] = obj.version
+    if obj.coalesce_version_seconds is not None:
+        attr["changed"] = datetime.datetime.utcnow()
+
     hist = history_cls()
     for key, value in attr.items():
         setattr(hist, key, value)
@@ -317,6 +422,22 @@ def create_version(obj, session, deleted=False):
     
     obj.version += 1
 
+    #a stale entry (e.g. after a rollback) no longer matches obj.version
+    if obj.coalesce_version_seconds is not None:
+        obj._version_began = (obj.version, attr["changed"])
+
+    if obj.coalesce_version_transaction:
+        versioned = session.info.setdefault(_TXN_VERSIONED, {})
+        versioned[attributes.instance_state(obj)] = _savepoint(session)
+
+    _record_change(
+        session,
+        obj,
+        attr["version"],
+        None if deleted else obj.version,
+        changed_keys,
+    )
+
 #event handler defined on its own to create object to refer to for removal
 #func was given in sqlalchemy example code
 def before_flush(session, flush_context, instances):
@@ -325,9 +446,153 @@ def before_flush(session, flush_context, instances):
     for obj in versioned_objects(session.deleted):
         create_version(obj, session, deleted=True)
 
+def after_soft_rollback(session, previous_transaction):
+    '''Forgets objects versioned and changes recorded within a rolled back
+    transaction or savepoint, as their history rows no longer exist.'''
+
+    #a rolled back subtransaction rolls back its enclosing savepoint/root
+    boundary = previous_transaction
+    while boundary.parent is not None and not boundary.nested:
+        boundary = boundary.parent
+
+    versioned = session.info.get(_TXN_VERSIONED)
+    if versioned:
+        for state, transaction in list(versioned.items()):
+            if _rolled_back(transaction, boundary):
+                del versioned[state]
+
+    changes = session.info.get(_TXN_CHANGES)
+    if changes:
+        changes[:] = [
+            (transaction, change) for transaction, change in changes
+            if not _rolled_back(transaction, boundary)
+        ]
+
+def after_commit(session):
+    '''Notifies subscribers of the changes made in a committed transaction.
+    Savepoint releases are ignored; their changes go out with the
+    transaction's.'''
+
+    if session.get_nested_transaction() is not None:
+        return
+
+    changes = session.info.pop(_TXN_CHANGES, None)
+    if changes:
+        _notify(_merge_changes(change for transaction, change in changes))
+
+def after_transaction_end(session, transaction):
+    if transaction.parent is None:
+        session.info.pop(_TXN_VERSIONED, None)
+        session.info.pop(_TXN_CHANGES, None)
+
 def version_session(session):
     event.listen(session, "before_flush", before_flush)
+    event.listen(session, "after_soft_rollback", after_soft_rollback)
+    event.listen(session, "after_commit", after_commit)
+    event.listen(session, "after_transaction_end", after_transaction_end)
 
 def deversion_session(session):
     event.remove(session, "before_flush", before_flush)
+    event.remove(session, "after_soft_rollback", after_soft_rollback)
+    event.remove(session, "after_commit", after_commit)
+    event.remove(session, "after_transaction_end", after_transaction_end)
+
+Change = namedtuple("Change", "model key old_version new_version columns")
+Change.__doc__ = '''A versioned object changed in a committed transaction:
+its class, primary key tuple, version before and after the transaction's
+flushes (new_version is None if it was deleted, and equal to old_version if
+the change was coalesced) and the keys of the attributes that changed.'''
+
+#registered (callback, threaded) pairs, and the queue of the worker thread
+#delivering threaded notifications
+_subscribers = []
+_queue = None
+_queue_lock = threading.Lock()
+
+def _record_change(session, obj, old_version, new_version, columns):
+    if not _subscribers:
+        return
+
+    change = Change(
+        type(obj),
+        object_mapper(obj).primary_key_from_instance(obj),
+        old_version,
+        new_version,
+        tuple(columns),
+    )
+    changes = session.info.setdefault(_TXN_CHANGES, [])
+    changes.append((_savepoint(session), change))
+
+def _merge_changes(changes):
+    '''Merges the changes recorded by successive flushes of the same object
+    into one, spanning the versions before and after the transaction.'''
+
+    merged = {}
+    for change in changes:
+        previous = merged.get((change.model, change.key))
+        if previous is not None:
+            change = change._replace(
+                old_version=previous.old_version,
+                columns=previous.columns + tuple(
+                    c for c in change.columns if c not in previous.columns
+                ),
+            )
+        merged[(change.model, change.key)] = change
+
+    return list(merged.values())
+
+def _deliver(callback, changes):
+    try:
+        callback(changes)
+    except Exception:
+        log.exception("history change subscriber %r failed", callback)
+
+def _worker():
+    while True:
+        callback, changes = _queue.get()
+        try:
+            _deliver(callback, changes)
+        finally:
+            _queue.task_done()
+
+def _worker_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = queue.Queue()
+            threading.Thread(
+                target=_worker, name="history-notifications", daemon=True
+            ).start()
+    return _queue
+
+def _notify(changes):
+    for callback, threaded in list(_subscribers):
+        if threaded:
+            _worker_queue().put((callback, changes))
+        else:
+            _deliver(callback, changes)
+
+def subscribe(callback, threaded=False):
+    '''Registers `callback` to be called with the list of Change tuples of
+    each committed transaction of a versioned session that changed versioned
+    objects. Changes from rolled back transactions or savepoints are never
+    delivered. Inserts aren't versioned, so they aren't reported.
+
+    Callbacks are called synchronously in the committing thread, after the
+    commit, unless `threaded` is True, in which case they're called in order
+    from a shared background thread. Exceptions raised by callbacks are
+    logged rather than propagated.
+    '''
+
+    _subscribers.append((callback, threaded))
+
+def unsubscribe(callback):
+    _subscribers[:] = [s for s in _subscribers if s[0] != callback]
+
+def wait_for_notifications():
+    '''Blocks until all threaded notifications queued so far have been
+    delivered.'''
+
+    if _queue is not None:
+        _queue.join()
     
@@ -0,0 +1,480 @@
+"""Alembic helpers for evolving history tables.
+
+history_drift() compares the history tables built by _history_mapper with the
+database and returns the alembic operations needed to bring them in line;
+render_history_drift() turns those into migration script code. History tables
+keep every row ever written, so unlike plain autogenerate, columns dropped from
+a model are never dropped from its history table, and added columns are always
+nullable since existing history rows have no value for them. A column whose
+type changed isn't ALTERed in place, which would rewrite the table under a
+lock: the values are copied into a new column with op.backfill_history() and
+the new column then replaces the old one, after catching up on rows written
+during the copy. Configuring include_object() in a project's env.py makes
+alembic autogenerate do the same.
+
+backfill_history() rewrites existing history rows in short keyset-paginated
+chunks, each in its own transaction, so backfills and type transforms on very
+large history tables never hold a long lock and can be resumed. It is also
+available inside migration scripts as op.backfill_history().
+"""
+
+import time
+import warnings
+from contextlib import nullcontext
+
+from alembic.autogenerate import comparators
+from alembic.autogenerate import render
+from alembic.autogenerate import render_python_code
+from alembic.autogenerate import renderers
+from alembic.operations import MigrateOperation
+from alembic.operations import Operations
+from alembic.operations import ops
+from alembic.runtime.migration import MigrationContext
+from sqlalchemy import and_
+from sqlalchemy import cast
+from sqlalchemy import Column
+from sqlalchemy import column
+from sqlalchemy import inspect
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import Table
+from sqlalchemy import tuple_
+
+def history_tables(metadata):
+    '''Returns the history tables in `metadata`, i.e. those holding the
+    "history_copy" columns of versioned tables, in dependency order.'''
+
+    copies = {
+        col.info["history_copy"].table
+        for table in metadata.tables.values()
+        for col in table.c
+        if "history_copy" in col.info
+    }
+
+    return [t for t in metadata.sorted_tables if t in copies]
+
+def _retype_ops(table, db_col, col):
+    '''Changes the type of a history table column by copying its values into
+    a new column, in chunks, and swapping that in. Rows written behind the
+    copy while it runs are caught up by the swap.'''
+
+    if db_col.primary_key:
+        warnings.warn(
+            "%s.%s: the type of a primary key column of a history table "
+            "changed; this must be migrated by hand" % (table.name, col.name)
+        )
+        return []
+
+    new_name = col.name + "_new"
+    return [
+        ops.AddColumnOp.from_column_and_tablename(
+            table.schema, table.name, Column(new_name, col.type, nullable=True)
+        ),
+        BackfillHistoryOp.copy_column(
+            table.name, db_col.name, new_name, col.type, schema=table.schema
+        ),
+        SwapHistoryColumnOp(
+            table.name,
+            db_col.name,
+            new_name,
+            col.type,
+            existing_type=db_col.type,
+            schema=table.schema,
+        ),
+    ]
+
+def _drift_ops(migration_ctx, table, db_table):
+    found = []
+
+    for col in table.c:
+        if col.key not in db_table.c:
+            new_col = col.copy()
+            new_col.nullable = True
+            found.append(
+                ops.AddColumnOp.from_column_and_tablename(
+                    table.schema, table.name, new_col
+                )
+            )
+            continue
+
+        db_col = db_table.c[col.key]
+        if migration_ctx.impl.compare_type(db_col, col):
+            found.extend(_retype_ops(table, db_col, col))
+
+    #columns removed from the model keep their history; they only need to
+    #accept NULL so that new history rows can still be inserted
+    for db_col in db_table.c:
+        if db_col.key not in table.c and not db_col.nullable:
+            found.append(
+                ops.AlterColumnOp(
+                    table.name,
+                    db_col.name,
+                    schema=table.schema,
+                    existing_type=db_col.type,
+                    existing_nullable=False,
+                    modify_nullable=True,
+                )
+            )
+
+    return found
+
+def history_drift(connection, metadata, schemas=None):
+    '''Returns a list of alembic operations describing how the history tables
+    in the database differ from those in `metadata`, optionally only those in
+    `schemas` (None being the default schema).'''
+
+    migration_ctx = MigrationContext.configure(connection)
+    inspector = inspect(connection)
+    found = []
+
+    for table in history_tables(metadata):
+        if schemas is not None and table.schema not in schemas:
+            continue
+        if not inspector.has_table(table.name, schema=table.schema):
+            found.append(ops.CreateTableOp.from_table(table))
+            continue
+
+        db_table = Table(
+            table.name,
+            MetaData(),
+            schema=table.schema,
+            autoload_with=connection,
+        )
+        found.extend(_drift_ops(migration_ctx, table, db_table))
+
+    return found
+
+def render_history_drift(connection, metadata):
+    '''Returns the body of an upgrade() function applying history_drift().'''
+
+    return render_python_code(
+        ops.UpgradeOps(ops=history_drift(connection, metadata))
+    )
+
+def include_object(object, name, type_, reflected, compare_to):
+    '''Alembic include_object hook leaving history tables out of plain
+    autogenerate, which would drop their removed columns and ALTER their types
+    in place. With it configured, autogenerate emits history_drift() for them
+    instead:
+
+        context.configure(..., include_object=migration.include_object)
+
+    Tables only in the database are taken to be history tables, and kept, if
+    their name ends in "_history".
+    '''
+
+    if type_ != "table":
+        return True
+
+    if not reflected:
+        return object not in history_tables(object.metadata)
+    if compare_to is not None:
+        return compare_to not in history_tables(compare_to.metadata)
+    return not name.endswith("_history")
+
+@comparators.dispatch_for("schema")
+def _compare_history_tables(autogen_context, upgrade_ops, schemas):
+    #only when the history tables were left out of the plain comparison
+    if autogen_context.opts.get("include_object") is not include_object:
+        return
+
+    metadata = autogen_context.metadata
+    if not isinstance(metadata, (list, tuple)):
+        metadata = [metadata]
+
+    for md in metadata:
+        upgrade_ops.ops.extend(
+            history_drift(autogen_context.connection, md, schemas)
+        )
+
+def _reflect(connection, table, schema=None):
+    if isinstance(table, Table):
+        return table
+
+    return Table(table, MetaData(), schema=schema, autoload_with=connection)
+
+def backfill_history(connection, table, values, where=None, chunk_size=10000,
+                     pause=0.0, start_after=None, schema=None):
+    '''Updates rows of a history table in primary key order, `chunk_size` rows
+    at a time, yielding the last primary key (a tuple ending in the version)
+    of each chunk once it is committed.
+
+    `table` is a Table or table name, `values` a dict of column key to value
+    or SQL expression as for Update.values(), and `where` an optional criterion
+    limiting the rows updated. Either may instead be a callable taking the
+    (reflected) table. A criterion that excludes already processed rows, e.g.
+    `new_col IS NULL`, makes the backfill idempotent; alternatively pass the
+    last yielded key back as `start_after` to resume. `pause` seconds are
+    slept between chunks to throttle load on the database.
+
+    Each chunk's SELECT and UPDATE run in a transaction of their own, which is
+    committed before the chunk's key is yielded, so `connection` must not
+    already be in a transaction.
+    '''
+
+    if connection.in_transaction():
+        raise ValueError(
+            "backfill_history commits each chunk itself and can't run on a "
+            "connection that is already in a transaction"
+        )
+
+    return _backfill(
+        connection, table, values, where, chunk_size, pause, start_after,
+        schema, connection.begin,
+    )
+
+def _backfill(connection, table, values, where, chunk_size, pause,
+              start_after, schema, transaction):
+    table = _reflect(connection, table, schema)
+    if callable(values):
+        values = values(table)
+    if callable(where):
+        where = where(table)
+
+    key_cols = list(table.primary_key.columns)
+    key = tuple_(*key_cols)
+    last = tuple(start_after) if start_after is not None else None
+
+    while True:
+        stmt = select(*key_cols).order_by(*key_cols).limit(chunk_size)
+        if last is not None:
+            stmt = stmt.where(key > tuple_(*last))
+        if where is not None:
+            stmt = stmt.where(where)
+
+        with transaction():
+            keys = connection.execute(stmt).all()
+            if not keys:
+                return
+
+            first, last = tuple(keys[0]), tuple(keys[-1])
+            update = (
+                table.update()
+                .where(key >= tuple_(*first), key <= tuple_(*last))
+                .values(values)
+            )
+            if where is not None:
+                update = update.where(where)
+
+            connection.execute(update)
+
+        yield last
+
+        if len(keys) < chunk_size:
+            return
+
+        if pause:
+            time.sleep(pause)
+
+
+@Operations.register_operation("backfill_history")
+class BackfillHistoryOp(MigrateOperation):
+    '''Migration operation running backfill_history() on a history table.
+    Chunks are committed individually inside an autocommit block, so the
+    migration's own transaction is committed before it starts.'''
+
+    def __init__(self, table_name, values, where=None, chunk_size=10000,
+                 pause=0.0, start_after=None, schema=None):
+        self.table_name = table_name
+        self.values = values
+        self.where = where
+        self.chunk_size = chunk_size
+        self.pause = pause
+        self.start_after = start_after
+        self.schema = schema
+
+        #(source, target, type) of a column copy made by copy_column(), the
+        #only form that can be rendered into a migration script
+        self.copy = None
+
+    @classmethod
+    def backfill_history(cls, operations, table_name, values, **kw):
+        '''Backfill existing rows of a history table in bounded chunks.'''
+
+        return operations.invoke(cls(table_name, values, **kw))
+
+    @classmethod
+    def copy_column(cls, table_name, source, target, type_, **kw):
+        '''Returns an operation copying column `source` into `target`, cast
+        to `type_`. Rows already copied are skipped, so it can be rerun.'''
+
+        operation = cls(
+            table_name,
+            {target: cast(column(source), type_)},
+            where=and_(column(target).is_(None), column(source).isnot(None)),
+            **kw
+        )
+        operation.copy = (source, target, type_)
+        return operation
+
+    def reverse(self):
+        return _IrreversibleOp(
+            "backfill of history table %s can't be reversed" % self.table_name
+        )
+
+
+@Operations.implementation_for(BackfillHistoryOp)
+def _backfill_history(operations, operation):
+    migration_ctx = operations.get_context()
+    if migration_ctx.as_sql:
+        raise NotImplementedError(
+            "backfill_history requires a database connection and can't be "
+            "run in offline (--sql) mode"
+        )
+
+    #in the autocommit block every statement commits as soon as it's run,
+    #so chunks need no transaction of their own
+    with migration_ctx.autocommit_block():
+        for _ in _backfill(
+            operations.get_bind(),
+            operation.table_name,
+            operation.values,
+            operation.where,
+            operation.chunk_size,
+            operation.pause,
+            operation.start_after,
+            operation.schema,
+            nullcontext,
+        ):
+            pass
+
+@renderers.dispatch_for(BackfillHistoryOp)
+def _render_backfill_history(autogen_context, operation):
+    if operation.copy is None:
+        raise ValueError(
+            "only backfills made by BackfillHistoryOp.copy_column() can be "
+            "rendered"
+        )
+
+    source, target, type_ = operation.copy
+    sa = render._sqlalchemy_autogenerate_prefix(autogen_context)
+    args = [
+        repr(operation.table_name),
+        "{%r: %scast(%scolumn(%r), %s)}" % (
+            target, sa, sa, source, render._repr_type(type_, autogen_context)
+        ),
+        "where=%sand_(%scolumn(%r).is_(None), %scolumn(%r).isnot(None))" % (
+            sa, sa, target, sa, source
+        ),
+    ]
+    if operation.schema is not None:
+        args.append("schema=%r" % operation.schema)
+
+    return "%sbackfill_history(%s)" % (
+        render._alembic_autogenerate_prefix(autogen_context), ", ".join(args)
+    )
+
+
+
+@Operations.register_operation("swap_history_column")
+class SwapHistoryColumnOp(MigrateOperation):
+    '''Migration operation replacing history table column `column_name` with
+    `new_column_name`, a copy of it cast to `type_` made by
+    BackfillHistoryOp.copy_column().
+
+    Rows written since the copy are first caught up, then the old column is
+    dropped and the new one renamed, in one transaction. On PostgreSQL the
+    table is locked against writes beforehand; on SQLite the catch-up UPDATE
+    takes the database's write lock. Where DDL isn't transactional (e.g.
+    MySQL), writers must be stopped first.'''
+
+    def __init__(self, table_name, column_name, new_column_name, type_,
+                 existing_type=None, schema=None):
+        self.table_name = table_name
+        self.column_name = column_name
+        self.new_column_name = new_column_name
+        self.type_ = type_
+        self.existing_type = existing_type
+        self.schema = schema
+
+    @classmethod
+    def swap_history_column(cls, operations, table_name, column_name,
+                            new_column_name, type_, **kw):
+        '''Replace a history table column with its retyped copy.'''
+
+        return operations.invoke(
+            cls(table_name, column_name, new_column_name, type_, **kw)
+        )
+
+    def reverse(self):
+        return _IrreversibleOp(
+            "type change of history column %s.%s can't be reversed"
+            % (self.table_name, self.column_name)
+        )
+
+
+@Operations.implementation_for(SwapHistoryColumnOp)
+def _swap_history_column(operations, operation):
+    migration_ctx = operations.get_context()
+    table = Table(
+        operation.table_name,
+        MetaData(),
+        Column(operation.column_name, operation.existing_type),
+        Column(operation.new_column_name, operation.type_),
+        schema=operation.schema,
+    )
+    old = table.c[operation.column_name]
+    new = table.c[operation.new_column_name]
+
+    transaction = nullcontext()
+    if not migration_ctx.as_sql and not operations.get_bind().in_transaction():
+        transaction = operations.get_bind().begin()
+
+    with transaction:
+        if migration_ctx.dialect.name == "postgresql":
+            operations.execute(
+                "LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE"
+                % migration_ctx.dialect.identifier_preparer.format_table(table)
+            )
+
+        operations.execute(
+            table.update()
+            .values({new.key: cast(old, operation.type_)})
+            .where(new.is_(None), old.isnot(None))
+        )
+        operations.drop_column(
+            operation.table_name, operation.column_name,
+            schema=operation.schema,
+        )
+        operations.alter_column(
+            operation.table_name,
+            operation.new_column_name,
+            new_column_name=operation.column_name,
+            existing_type=operation.type_,
+            existing_nullable=True,
+            schema=operation.schema,
+        )
+
+@renderers.dispatch_for(SwapHistoryColumnOp)
+def _render_swap_history_column(autogen_context, operation):
+    args = [
+        repr(operation.table_name),
+        repr(operation.column_name),
+        repr(operation.new_column_name),
+        render._repr_type(operation.type_, autogen_context),
+    ]
+    if operation.existing_type is not None:
+        args.append("existing_type=%s" % render._repr_type(
+            operation.existing_type, autogen_context
+        ))
+    if operation.schema is not None:
+        args.append("schema=%r" % operation.schema)
+
+    return "%sswap_history_column(%s)" % (
+        render._alembic_autogenerate_prefix(autogen_context), ", ".join(args)
+    )
+
+
+class _IrreversibleOp(MigrateOperation):
+    '''Downgrade step of a history operation that can't be undone.'''
+
+    def __init__(self, message):
+        self.message = message
+
+@Operations.implementation_for(_IrreversibleOp)
+def _irreversible(operations, operation):
+    raise NotImplementedError(operation.message)
+
+@renderers.dispatch_for(_IrreversibleOp)
+def _render_irreversible(autogen_context, operation):
+    return "raise NotImplementedError(%r)" % operation.message
@@ -0,0 +1,324 @@
+"""Tiered storage for old history rows.
+
+archive_history() moves history rows changed before a cutoff out of the
+primary <name>_history table, in bulk, into a ColdStore: a directory of
+per-period SQLite files, one per history table and period (e.g. month). Cold
+tables are clustered on their primary key (WITHOUT ROWID) and store
+timestamps as integers to keep them compact.
+
+history_rows() reads a history table across both tiers, and the package's
+other history readers (analytics.iter_history_chunks(), asof.load_asof())
+accept a `store` to do the same. Cold partitions are pruned by the "changed"
+range of the read using their file names alone, so reads of recent history
+never open a cold file.
+"""
+
+import datetime
+import glob
+import heapq
+import os
+
+from sqlalchemy import Column
+from sqlalchemy import create_engine
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import Table
+from sqlalchemy import tuple_
+from sqlalchemy.types import TypeDecorator
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+class _Timestamp(TypeDecorator):
+    '''Naive UTC datetime stored as integer microseconds since the epoch.'''
+
+    impl = Integer
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return (value - _EPOCH) // datetime.timedelta(microseconds=1)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return _EPOCH + datetime.timedelta(microseconds=value)
+
+
+def _is_naive_datetime(type_):
+    return isinstance(type_, DateTime) and not type_.timezone
+
+def _add_months(dt, months):
+    month = dt.month - 1 + months
+    return dt.replace(year=dt.year + month // 12, month=month % 12 + 1)
+
+class ColdStore:
+    '''Directory of per-period SQLite files holding archived history rows.
+
+    `period` is one of "day", "month" or "year"; a row goes to the partition
+    of the period its "changed" timestamp falls in.
+    '''
+
+    periods = ("day", "month", "year")
+
+    def __init__(self, directory, period="month"):
+        if period not in self.periods:
+            raise ValueError("period must be one of %s" % (self.periods,))
+
+        self.directory = directory
+        self.period = period
+        self._engines = {}
+        self._tables = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        #engines are per process; a pickled store (e.g. sent to a worker
+        #process) opens its own
+        return {"directory": self.directory, "period": self.period}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def period_start(self, dt):
+        start = datetime.datetime(dt.year, dt.month, dt.day)
+        if self.period in ("month", "year"):
+            start = start.replace(day=1)
+        if self.period == "year":
+            start = start.replace(month=1)
+        return start
+
+    def period_end(self, start):
+        if self.period == "day":
+            return start + datetime.timedelta(days=1)
+        return _add_months(start, 1 if self.period == "month" else 12)
+
+    def _path(self, table, start):
+        return os.path.join(
+            self.directory,
+            "%s.%s.sqlite" % (table.name, start.strftime("%Y%m%d")),
+        )
+
+    def partitions(self, table, since=None, until=None):
+        '''Returns (start, end, path) of the partitions of history table
+        `table` that may hold rows changed within [since, until).'''
+
+        found = []
+        prefix = table.name + "."
+        pattern = os.path.join(glob.escape(self.directory),
+                               glob.escape(prefix) + "*.sqlite")
+
+        for path in sorted(glob.glob(pattern)):
+            stamp = os.path.basename(path)[len(prefix):-len(".sqlite")]
+            try:
+                start = datetime.datetime.strptime(stamp, "%Y%m%d")
+            except ValueError:
+                continue
+
+            end = self.period_end(start)
+            if since is not None and end <= since:
+                continue
+            if until is not None and start >= until:
+                continue
+
+            found.append((start, end, path))
+
+        return found
+
+    def cold_table(self, table):
+        '''Returns the cold copy of history table `table`: the same columns
+        and primary key, without foreign keys, defaults or indexes.'''
+
+        if table.name not in self._tables:
+            cols = [
+                Column(
+                    c.name,
+                    _Timestamp() if _is_naive_datetime(c.type) else c.type,
+                    key=c.key,
+                    primary_key=c.primary_key,
+                    autoincrement=False,
+                )
+                for c in table.c
+            ]
+            self._tables[table.name] = Table(
+                table.name, MetaData(), *cols, sqlite_with_rowid=False
+            )
+
+        return self._tables[table.name]
+
+    def engine(self, path):
+        if path not in self._engines:
+            self._engines[path] = create_engine("sqlite:///" + path)
+
+        return self._engines[path]
+
+    def write(self, table, rows):
+        '''Writes history rows (mappings by column key) to the partitions of
+        their "changed" period. Rows already present are replaced, so writing
+        is idempotent.'''
+
+        cold = self.cold_table(table)
+        by_period = {}
+        for row in rows:
+            start = self.period_start(row["changed"])
+            by_period.setdefault(start, []).append(row)
+
+        for start, period_rows in by_period.items():
+            engine = self.engine(self._path(table, start))
+            cold.create(engine, checkfirst=True)
+            with engine.begin() as conn:
+                conn.execute(
+                    cold.insert().prefix_with("OR REPLACE"), period_rows
+                )
+
+    def rows(self, table, where=None, since=None, until=None):
+        '''Yields an iterator of rows per partition of history table `table`
+        that overlaps [since, until), each ordered by primary key. `where` is
+        an optional callable taking the cold table and returning a criterion.
+        '''
+
+        cold = self.cold_table(table)
+        stmt = select(cold).order_by(*cold.primary_key.columns)
+        if since is not None:
+            stmt = stmt.where(cold.c.changed >= since)
+        if until is not None:
+            stmt = stmt.where(cold.c.changed < until)
+        if where is not None:
+            stmt = stmt.where(where(cold))
+
+        for start, end, path in self.partitions(table, since, until):
+            yield _stream(self.engine(path), stmt)
+
+    def close(self):
+        for engine in self._engines.values():
+            engine.dispose()
+        self._engines.clear()
+
+
+def _stream(engine, stmt):
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(stmt)
+        for row in result:
+            yield row
+
+def _history_table(cls):
+    return cls.__history_mapper__.local_table
+
+def _check_integer_keys(cls, table):
+    '''Raises ValueError unless `table`'s primary key is all integers.
+
+    Rows from both tiers are merged in Python order, which only matches the
+    databases' ORDER BY for integers: text keys sort by collation, e.g. a
+    PostgreSQL locale vs SQLite's binary comparison in cold tables.
+    '''
+
+    for col in table.primary_key.columns:
+        try:
+            integer = col.type.python_type is int
+        except NotImplementedError:
+            integer = False
+
+        if not integer:
+            raise ValueError(
+                "%s: tiered history storage requires an integer primary key"
+                % cls.__name__
+            )
+
+def archive_history(connection, cls, before, store, chunk_size=10000):
+    '''Moves the rows of Versioned class `cls`'s history table changed before
+    `before` into ColdStore `store`, `chunk_size` rows at a time, and returns
+    the number of rows moved. `cls` must have an integer primary key.
+
+    Chunks are read in primary key order, continuing after the last key of
+    the previous one. Each is written to the cold store before being deleted
+    from the hot table in a transaction of its own, so `connection` must not
+    already be in a transaction. An interrupted run loses nothing and can
+    simply be repeated. For joined inheritance, archive child classes before
+    their parents.
+    '''
+
+    if connection.in_transaction():
+        raise ValueError(
+            "archive_history commits each chunk itself and can't run on a "
+            "connection that is already in a transaction"
+        )
+
+    table = _history_table(cls)
+    _check_integer_keys(cls, table)
+
+    key_cols = list(table.primary_key.columns)
+    key = tuple_(*key_cols)
+    last = None
+    moved = 0
+
+    while True:
+        stmt = (
+            select(table)
+            .where(table.c.changed < before)
+            .order_by(*key_cols)
+            .limit(chunk_size)
+        )
+        if last is not None:
+            stmt = stmt.where(key > tuple_(*last))
+
+        with connection.begin():
+            rows = [dict(r) for r in connection.execute(stmt).mappings()]
+        if not rows:
+            return moved
+
+        store.write(table, rows)
+
+        keys = [tuple(r[c.key] for c in key_cols) for r in rows]
+        with connection.begin():
+            connection.execute(table.delete().where(key.in_(keys)))
+
+        last = keys[-1]
+        moved += len(rows)
+
+def history_rows(connection, cls, store=None, since=None, until=None,
+                 where=None):
+    '''Yields the history rows of Versioned class `cls` changed within
+    [since, until) from the hot table and, if given, ColdStore `store`,
+    merged in primary key then version order. `where` is an optional callable
+    taking a (hot or cold) history table and returning a criterion.
+
+    A row left in both tiers by an interrupted archive_history() run is
+    yielded once, from the hot table. A store can only be given for classes
+    with integer primary keys.
+    '''
+
+    table = _history_table(cls)
+    if store is not None:
+        _check_integer_keys(cls, table)
+
+    stmt = select(table).order_by(*table.primary_key.columns)
+    if since is not None:
+        stmt = stmt.where(table.c.changed >= since)
+    if until is not None:
+        stmt = stmt.where(table.c.changed < until)
+    if where is not None:
+        stmt = stmt.where(where(table))
+
+    hot = connection.execution_options(stream_results=True).execute(stmt)
+    if store is None:
+        yield from hot
+        return
+
+    cols = list(table.c)
+    key_idx = [cols.index(c) for c in table.primary_key.columns]
+
+    #a row's partition is fixed by its "changed" period, so duplicates can
+    #only be between the hot table and one cold partition
+    def keyed(rows, tier):
+        for row in rows:
+            yield tuple(row[i] for i in key_idx), tier, row
+
+    tiers = [keyed(hot, 0)] + [
+        keyed(rows, 1) for rows in store.rows(table, where, since, until)
+    ]
+    last = None
+    for key, tier, row in heapq.merge(*tiers, key=lambda t: t[:2]):
+        if key != last:
+            yield row
+        last = key
@@ -0,0 +1,369 @@
+"""Parallel integrity verification of history tables.
+
+The primary key space of each versioned model is split into ranges holding
+about `partition_size` rows each, found by keyset pagination over its history
+and live tables, so sparse or skewed keys don't produce empty or oversized
+ranges. Each range is checked with set-based queries in a pool of worker
+processes, each with its own database connection:
+
+- "version_gap": a row's history versions aren't exactly 1..N
+- "live_version": a live row's version isn't one greater than its latest
+  history row (or 1 when it has none)
+- "missing_parent": a joined-inheritance child history row has no matching
+  parent history row
+
+Given the tiering.ColdStore that history rows were archived to, the archived
+versions are taken into account as well.
+
+Reports are yielded per range (lo, hi] as they complete. A run can be resumed
+by passing the reports already received as `completed`; only the key ranges
+they don't cover are checked.
+"""
+
+import os
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
+from sqlalchemy import and_
+from sqlalchemy import column
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import table
+from sqlalchemy.orm import class_mapper
+
+from history_table.history_table import _is_versioning_col
+
+Violation = namedtuple("Violation", "check model key detail")
+PartitionReport = namedtuple("PartitionReport", "model lo hi violations")
+
+#plain-data description of a versioned model's tables, sent to the workers
+_ModelSpec = namedtuple(
+    "_ModelSpec", "model schema live history key parent parent_cols"
+)
+
+def _model_spec(cls):
+    history_mapper = cls.__history_mapper__
+    if history_mapper.single:
+        return None
+
+    history = history_mapper.local_table
+    keys = [
+        c for c in history.primary_key.columns if not _is_versioning_col(c)
+    ]
+    try:
+        integer = len(keys) == 1 and keys[0].type.python_type is int
+    except NotImplementedError:
+        integer = False
+
+    if not integer:
+        raise ValueError(
+            "%s: history verification requires a single integer primary key "
+            "column" % cls.__name__
+        )
+
+    #the live version column only exists on the base table of a hierarchy
+    live = None
+    if history_mapper.inherits is None:
+        live = class_mapper(cls).local_table.name
+
+    parent = parent_cols = None
+    if history_mapper.inherits is not None:
+        parent_table = history_mapper.inherits.local_table
+        for fk in history.foreign_key_constraints:
+            if fk.referred_table is parent_table:
+                parent = parent_table.name
+                parent_cols = tuple(
+                    (el.parent.name, el.column.name) for el in fk.elements
+                )
+
+    return _ModelSpec(
+        cls.__name__, history.schema, live, history.name, keys[0].name,
+        parent, parent_cols,
+    )
+
+def _table(spec, name, *cols):
+    return table(name, *(column(c) for c in cols), schema=spec.schema)
+
+def _in_range(key, lo, hi):
+    '''Criteria for lo < key <= hi, where None is unbounded.'''
+
+    criteria = []
+    if lo is not None:
+        criteria.append(key > lo)
+    if hi is not None:
+        criteria.append(key <= hi)
+    return criteria
+
+def _cold_results(store, name, stmt):
+    '''Yields the result rows of `stmt` in each cold partition of history
+    table `name`.'''
+
+    for start, end, path in store.partitions(table(name)):
+        with store.engine(path).connect() as conn:
+            yield from conn.execute(stmt)
+
+def _archived_versions(store, spec, lo, hi):
+    '''Returns the versions archived to `store` per key in (lo, hi].'''
+
+    h = table(spec.history, column(spec.key), column("version"))
+    stmt = select(h.c[spec.key], h.c.version).where(
+        *_in_range(h.c[spec.key], lo, hi)
+    )
+
+    archived = {}
+    for k, v in _cold_results(store, spec.history, stmt):
+        archived.setdefault(k, set()).add(v)
+    return archived
+
+def _check_gaps(conn, spec, lo, hi, archived=None):
+    h = _table(spec, spec.history, spec.key, "version")
+    key = h.c[spec.key]
+    count = func.count()
+    first = func.min(h.c.version)
+    last = func.max(h.c.version)
+
+    stmt = (
+        select(key, count, first, last)
+        .where(*_in_range(key, lo, hi))
+        .group_by(key)
+    )
+
+    if not archived:
+        rows = conn.execute(stmt.having(or_(first != 1, count != last)))
+    else:
+        #a row's versions may be split across the tiers, or be in both after
+        #an interrupted archive run
+        versions = {k: set(v) for k, v in archived.items()}
+        hot = select(key, h.c.version).where(*_in_range(key, lo, hi))
+        for k, v in conn.execute(hot):
+            versions.setdefault(k, set()).add(v)
+
+        rows = [
+            (k, len(v), min(v), max(v)) for k, v in sorted(versions.items())
+            if min(v) != 1 or len(v) != max(v)
+        ]
+
+    return [
+        Violation("version_gap", spec.model, k, {
+            "count": n, "min_version": v0, "max_version": v1
+        })
+        for k, n, v0, v1 in rows
+    ]
+
+def _check_live(conn, spec, lo, hi, archived=None):
+    h = _table(spec, spec.history, spec.key, "version")
+    live = _table(spec, spec.live, spec.key, "version")
+
+    latest = (
+        select(
+            h.c[spec.key].label("key"),
+            func.max(h.c.version).label("version"),
+        )
+        .where(*_in_range(h.c[spec.key], lo, hi))
+        .group_by(h.c[spec.key])
+        .subquery()
+    )
+    history_version = func.coalesce(latest.c.version, 0)
+
+    stmt = (
+        select(live.c[spec.key], live.c.version, history_version)
+        .select_from(
+            live.outerjoin(latest, live.c[spec.key] == latest.c.key)
+        )
+        .where(
+            history_version != live.c.version - 1,
+            *_in_range(live.c[spec.key], lo, hi)
+        )
+    )
+
+    violations = []
+    for k, v, hv in conn.execute(stmt):
+        #all of a row's history may have been archived
+        if archived and k in archived:
+            hv = max(hv, max(archived[k]))
+
+        if hv != v - 1:
+            violations.append(Violation("live_version", spec.model, k, {
+                "live_version": v, "history_version": hv
+            }))
+
+    return violations
+
+def _check_parents(conn, spec, lo, hi, store=None):
+    child_cols, parent_cols = zip(*spec.parent_cols)
+    c = _table(spec, spec.history, spec.key, "version", *child_cols)
+    p = _table(spec, spec.parent, *parent_cols)
+
+    stmt = (
+        select(c.c[spec.key], c.c.version, *(c.c[a] for a in child_cols))
+        .select_from(c.outerjoin(p, and_(*(
+            c.c[a] == p.c[b] for a, b in spec.parent_cols
+        ))))
+        .where(
+            p.c[parent_cols[0]].is_(None),
+            *_in_range(c.c[spec.key], lo, hi)
+        )
+    )
+
+    #parent history rows may have been archived before their children's
+    archived = set()
+    if store is not None:
+        cold = table(spec.parent, *(column(b) for b in parent_cols))
+        parent_key = cold.c[dict(spec.parent_cols)[spec.key]]
+        archived = {
+            tuple(row) for row in _cold_results(
+                store,
+                spec.parent,
+                select(*cold.c).where(*_in_range(parent_key, lo, hi)),
+            )
+        }
+
+    return [
+        Violation("missing_parent", spec.model, k, {"version": v})
+        for k, v, *parent in conn.execute(stmt)
+        if tuple(parent) not in archived
+    ]
+
+def _check_partition(engine, spec, lo, hi, store=None):
+    archived = None
+    if store is not None:
+        archived = _archived_versions(store, spec, lo, hi)
+
+    with engine.connect() as conn:
+        violations = _check_gaps(conn, spec, lo, hi, archived)
+        if spec.live is not None:
+            violations += _check_live(conn, spec, lo, hi, archived)
+        if spec.parent is not None:
+            violations += _check_parents(conn, spec, lo, hi, store)
+
+    return PartitionReport(spec.model, lo, hi, violations)
+
+#per-process engine and cold store, created by the pool initializer so that
+#no connection is ever shared across a fork
+_worker_engine = None
+_worker_store = None
+
+def _init_worker(url, store):
+    global _worker_engine, _worker_store
+    _worker_engine = create_engine(url)
+    _worker_store = store
+
+def _run_partition(spec, lo, hi):
+    return _check_partition(_worker_engine, spec, lo, hi, _worker_store)
+
+def _boundaries(conn, spec, name, lo, hi, partition_size):
+    '''Returns the keys splitting the rows of table `name` with keys in
+    (lo, hi] into runs of about `partition_size` rows, never splitting a key.
+    '''
+
+    key = _table(spec, name, spec.key).c[spec.key]
+    found = []
+
+    while True:
+        stmt = (
+            select(key)
+            .where(*_in_range(key, lo, hi))
+            .order_by(key)
+            .offset(partition_size - 1)
+            .limit(1)
+        )
+        lo = conn.execute(stmt).scalar()
+        if lo is None or lo == hi:
+            return found
+        found.append(lo)
+
+def _uncovered(done):
+    '''Returns the (lo, hi] ranges of the key space not covered by the
+    non-overlapping ranges `done`, where None is unbounded.'''
+
+    gaps = []
+    last = None
+    for lo, hi in sorted(done, key=lambda r: (r[0] is not None, r[0])):
+        if lo is not None and (last is None or lo > last):
+            gaps.append((last, lo))
+        if hi is None:
+            return gaps
+        last = hi if last is None else max(last, hi)
+
+    gaps.append((last, None))
+    return gaps
+
+def _partitions(url, specs, partition_size, completed):
+    done = {}
+    for model, lo, hi, *_ in completed:
+        done.setdefault(model, []).append((lo, hi))
+
+    todo = []
+    engine = create_engine(url)
+    try:
+        with engine.connect() as conn:
+            for spec in specs:
+                names = [spec.history] + ([spec.live] if spec.live else [])
+
+                for lo, hi in _uncovered(done.get(spec.model, ())):
+                    bounds = set()
+                    for name in names:
+                        bounds.update(_boundaries(
+                            conn, spec, name, lo, hi, partition_size
+                        ))
+
+                    edges = [lo] + sorted(bounds) + [hi]
+                    todo += [
+                        (spec, a, b) for a, b in zip(edges, edges[1:])
+                    ]
+    finally:
+        engine.dispose()
+
+    return todo
+
+def verify_history(url, classes, partition_size=100000, workers=None,
+                   completed=(), store=None):
+    '''Verifies the history of the given Versioned classes in the database at
+    `url`, yielding a PartitionReport for each primary key range as it's
+    checked. Results arrive in completion order, not key order. The first
+    and last ranges of each model are open ended (lo or hi is None).
+
+    `partition_size` is the approximate number of rows per range. `workers` is
+    the process pool size (None for one per CPU, 0 to check in this process).
+    Key ranges covered by `completed`, the PartitionReports (or (model name,
+    lo, hi) tuples) of an interrupted run, are skipped. If history rows were
+    archived, pass their tiering.ColdStore as `store`.
+    '''
+
+    specs = [s for s in map(_model_spec, classes) if s is not None]
+
+    #computed up front, so the bounds connection is closed before forking
+    todo = _partitions(url, specs, partition_size, completed)
+
+    if workers == 0:
+        engine = create_engine(url)
+        try:
+            for spec, lo, hi in todo:
+                yield _check_partition(engine, spec, lo, hi, store)
+        finally:
+            engine.dispose()
+        return
+
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(url, store)) as pool:
+        #bound the number of queued partitions rather than submitting all
+        max_pending = workers * 4
+        pending = set()
+
+        for spec, lo, hi in todo:
+            pending.add(pool.submit(_run_partition, spec, lo, hi))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
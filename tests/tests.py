@@ -1,8 +1,16 @@
 import pytest
 
+import sqlalchemy
+
 import history_table.history_table as ht
+import history_table.analytics as analytics
+import history_table.asof as asof
+import history_table.migration as migration
+import history_table.tiering as tiering
+import history_table.verify as verify
 from sqlalchemy import create_engine, event
 from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import select, text
 from sqlalchemy.orm import Session, relationship
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
@@ -10,10 +18,15 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import engine_from_config
 from alembic import autogenerate
 from alembic.config import Config
+from alembic.operations import Operations
+from alembic.operations import ops
+from alembic.runtime.migration import MigrationContext
 from alembic.runtime.environment import EnvironmentContext
 from alembic.script import ScriptDirectory
 
+import datetime
 import os
+import time
 
 @pytest.fixture(scope="session")
 def base():
@@ -260,3 +273,945 @@ def test_migration(engine, base):
     assert os.path.exists('versions/testmigration_.py')
 
     #TODO add auto check for correct content of file rather than manual review
+
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_change_statistics(db_versioned_session, engine, base):
+    '''Tests the streamed change statistics against a small history table,
+    using a chunk size small enough that versions of the same row straddle
+    chunk boundaries.
+    '''
+
+    session = db_versioned_session
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+        other = Column(String)
+
+    Base.metadata.create_all(engine)
+
+    hot = MyModel(data = 'a', other = 'x')
+    cold = MyModel(data = 'a', other = 'x')
+    session.add_all([hot, cold])
+    session.commit()
+
+    for i in range(5):
+        hot.data = 'data %d' % i
+        session.commit()
+
+    cold.other = 'y'
+    session.commit()
+    cold.other = 'z'
+    session.commit()
+
+    stats = analytics.change_statistics(
+        session.connection(), MyModel, chunk_size = 2, top = 1
+    )
+
+    #5 history rows for hot, 2 for cold; the first version of each row has
+    #nothing to be compared against
+    assert stats.rows == 7
+    assert stats.column_changes == {'data': 4, 'other': 1}
+    assert stats.interval_counts.sum() == 5
+    assert stats.hot_keys() == [((hot.id,), 5)]
+
+    hourly = analytics.change_statistics(
+        session.connection(), MyModel, hot_interval = datetime.timedelta(hours=1)
+    )
+
+    assert sum(count for key, count in hourly.hot_keys()) == 7
+
+    orm.clear_mappers()
+    Base.metadata.drop_all(engine)
+    Base.metadata.clear()
+
+def test_coalesce_transaction(db_versioned_session, engine, base):
+    '''Tests that a model coalescing by transaction writes a single history
+    row, holding the pre-transaction state, however many times it's flushed,
+    and that a rolled back savepoint doesn't swallow a later history row.
+    '''
+
+    session = db_versioned_session
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        coalesce_version_transaction = True
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+
+    Base.metadata.create_all(engine)
+
+    ModelHistory = MyModel.__history_mapper__.class_
+
+    model = MyModel(data = 'initial data')
+    session.add(model)
+    session.commit()
+
+    for i in range(3):
+        model.data = 'change %d' % i
+        session.flush()
+
+    session.commit()
+
+    assert model.version == 2
+    assert [h.data for h in session.query(ModelHistory)] == ['initial data']
+
+    savepoint = session.begin_nested()
+    model.data = 'discarded'
+    session.flush()
+    savepoint.rollback()
+
+    model.data = 'kept'
+    session.commit()
+
+    assert model.version == 3
+    assert [h.data for h in session.query(ModelHistory)] == [
+        'initial data', 'change 2'
+    ]
+
+    orm.clear_mappers()
+    Base.metadata.drop_all(engine)
+    Base.metadata.clear()
+
+def test_coalesce_seconds(db_versioned_session, engine, base):
+    '''Tests that changes within the coalescing window of a model's current
+    version are folded into it, and that the next change after the window
+    records the latest folded state under the same version number.
+    '''
+
+    session = db_versioned_session
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        coalesce_version_seconds = 60
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+
+    Base.metadata.create_all(engine)
+
+    ModelHistory = MyModel.__history_mapper__.class_
+
+    model = MyModel(data = 'initial data')
+    session.add(model)
+    session.commit()
+
+    model.data = 'first change'
+    session.commit()
+
+    #the start of the current version is known without querying history
+    history_selects = []
+    def count(conn, cursor, statement, *args):
+        if statement.startswith('SELECT') and 'mytable_history' in statement:
+            history_selects.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+
+    for i in range(3):
+        model.data = 'hot change %d' % i
+        session.commit()
+
+    event.remove(engine, 'before_cursor_execute', count)
+
+    assert history_selects == []
+    assert model.version == 2
+    assert session.query(ModelHistory).count() == 1
+
+    #age the start of version 2 past the window, and reload the model so that
+    #it is looked up
+    hist = session.query(ModelHistory).one()
+    hist.changed -= datetime.timedelta(minutes = 2)
+    session.commit()
+
+    session.expunge(model)
+    model = session.query(MyModel).one()
+    model.data = 'later change'
+    session.commit()
+
+    assert model.version == 3
+    assert [(h.version, h.data) for h in session.query(ModelHistory)] == [
+        (1, 'initial data'), (2, 'hot change 2')
+    ]
+
+    orm.clear_mappers()
+    Base.metadata.drop_all(engine)
+    Base.metadata.clear()
+
+def test_coalesce_mapper_versioning(base):
+    '''Tests that coalescing can't be combined with mapper versioning, which
+    would bump the version of coalesced changes.
+    '''
+
+    Base = base
+
+    with pytest.raises(ValueError):
+        class MyModel(Base, ht.Versioned):
+            __tablename__ = 'mytable'
+
+            use_mapper_versioning = True
+            coalesce_version_transaction = True
+
+            id = Column(Integer, primary_key = True)
+            data = Column(String)
+
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_history_drift(engine, base):
+    '''Tests that drift between a model's history table and the database is
+    detected and rendered without dropping columns from the history table,
+    and that type changes are rendered as a chunked copy rather than an ALTER.
+    '''
+
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+        amount = Column(String)
+        added = Column(Integer, nullable = False)
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE mytable_history (id INTEGER, data VARCHAR, "
+            "amount INTEGER, removed VARCHAR NOT NULL, version INTEGER, "
+            "changed DATETIME, PRIMARY KEY (id, version))"
+        ))
+        connection.execute(text(
+            "INSERT INTO mytable_history (id, amount, removed, version) "
+            "VALUES (1, 5, 'r', 1), (2, NULL, 'r', 1)"
+        ))
+
+    with engine.connect() as connection:
+        drift = migration.history_drift(connection, Base.metadata)
+        rendered = migration.render_history_drift(connection, Base.metadata)
+
+    assert len(drift) == 5
+
+    add_new, backfill, swap, add, alter = drift
+    assert (add.table_name, add.column.name) == ('mytable_history', 'added')
+    assert add.column.nullable
+    assert add_new.column.name == 'amount_new'
+    assert backfill.copy[:2] == ('amount', 'amount_new')
+    assert (swap.column_name, swap.new_column_name) == ('amount', 'amount_new')
+    assert (alter.column_name, alter.modify_nullable) == ('removed', True)
+    assert 'op.add_column' in rendered
+    assert 'op.backfill_history' in rendered
+    assert 'op.swap_history_column' in rendered
+    assert 'type_=' not in rendered
+    assert "drop_column('mytable_history', 'removed')" not in rendered
+
+    def run(*operations):
+        code = autogenerate.render_python_code(
+            ops.UpgradeOps(ops = list(operations))
+        )
+        code = '\n'.join(line.strip() for line in code.splitlines())
+        exec(code, {'op': op, 'sa': sqlalchemy})
+
+    #run the rendered type change (SQLite can't ALTER a column's nullability),
+    #with a new version of an already copied row written before the swap
+    with engine.connect() as connection:
+        op = Operations(MigrationContext.configure(connection))
+        run(add_new, backfill)
+
+        connection.execute(text(
+            "INSERT INTO mytable_history (id, amount, removed, version) "
+            "VALUES (1, 7, 'r', 2)"
+        ))
+        run(swap)
+
+        rows = connection.execute(text(
+            "SELECT id, version, amount, typeof(amount) FROM mytable_history "
+            "ORDER BY id, version"
+        )).all()
+        assert rows == [
+            (1, 1, '5', 'text'), (1, 2, '7', 'text'), (2, 1, None, 'null')
+        ]
+
+        connection.execute(text("DROP TABLE mytable_history"))
+
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_autogenerate_history(tmp_path, base):
+    '''Tests that with the include_object hook configured, autogenerate leaves
+    history tables to history_drift() rather than dropping or ALTERing their
+    columns, while still comparing other tables as usual.
+    '''
+
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        amount = Column(String)
+        added = Column(String)
+
+    engine = create_engine('sqlite:///%s' % (tmp_path / 'history.sqlite'))
+    with engine.begin() as connection:
+        connection.execute(text(
+            "CREATE TABLE mytable (id INTEGER PRIMARY KEY, amount VARCHAR, "
+            "version INTEGER NOT NULL)"
+        ))
+        connection.execute(text(
+            "CREATE TABLE mytable_history (id INTEGER, amount INTEGER, "
+            "removed VARCHAR, version INTEGER, changed DATETIME, "
+            "PRIMARY KEY (id, version))"
+        ))
+        connection.execute(text(
+            "CREATE TABLE gone_history (id INTEGER PRIMARY KEY)"
+        ))
+
+    with engine.connect() as connection:
+        migration_ctx = MigrationContext.configure(connection, opts = {
+            'target_metadata': Base.metadata,
+            'include_object': migration.include_object,
+        })
+        script = autogenerate.produce_migrations(migration_ctx, Base.metadata)
+
+        upgrade = autogenerate.render_python_code(script.upgrade_ops)
+        downgrade = autogenerate.render_python_code(script.downgrade_ops)
+
+    assert "op.add_column('mytable', sa.Column('added'" in upgrade
+    assert "op.add_column('mytable_history', sa.Column('added'" in upgrade
+    assert 'op.backfill_history' in upgrade
+    assert 'op.swap_history_column' in upgrade
+    assert 'drop_column' not in upgrade
+    assert 'drop_table' not in upgrade
+    assert 'type_=' not in upgrade
+    assert 'raise NotImplementedError' in downgrade
+
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_backfill_history(engine, base):
+    '''Tests chunked, resumable backfilling of a history table, both directly
+    and as an alembic operation.
+    '''
+
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+        added = Column(String)
+
+    Base.metadata.create_all(engine)
+
+    history = MyModel.__history_mapper__.local_table
+
+    with engine.begin() as connection:
+        connection.execute(history.insert(), [
+            {'id': i // 3, 'version': i % 3 + 1, 'data': str(i)}
+            for i in range(7)
+        ])
+
+    with engine.connect() as connection:
+        chunks = migration.backfill_history(
+            connection,
+            'mytable_history',
+            lambda t: {'added': 'x' + t.c.data},
+            chunk_size = 2,
+        )
+        assert next(chunks) == (0, 2)
+        chunks.close()
+
+        #resume from the first chunk's key
+        keys = list(migration.backfill_history(
+            connection,
+            history,
+            {'added': 'y' + history.c.data},
+            chunk_size = 2,
+            start_after = (0, 2),
+        ))
+
+        assert keys == [(1, 1), (1, 3), (2, 1)]
+
+        added = connection.execute(
+            history.select().order_by(history.c.id, history.c.version)
+        ).all()
+        assert [row.added for row in added] == [
+            'x0', 'x1', 'y2', 'y3', 'y4', 'y5', 'y6'
+        ]
+
+        op = Operations(MigrationContext.configure(connection))
+        op.backfill_history(
+            'mytable_history',
+            {'added': None},
+            where = lambda t: t.c.id == 2,
+        )
+
+        assert connection.execute(
+            history.select().where(history.c.added.is_(None))
+        ).all()[0].data == '6'
+
+    Base.metadata.drop_all(engine)
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_backfill_history_transactions(tmp_path, base):
+    '''Tests that backfill chunks are committed on future mode connections,
+    and that a connection already in a transaction is refused.
+    '''
+
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+
+    engine = create_engine(
+        'sqlite:///%s' % (tmp_path / 'history.sqlite'), future = True
+    )
+    Base.metadata.create_all(engine)
+
+    history = MyModel.__history_mapper__.local_table
+
+    with engine.begin() as connection:
+        connection.execute(history.insert(), [
+            {'id': i, 'version': 1, 'data': 'old'} for i in range(5)
+        ])
+
+    with engine.connect() as connection:
+        keys = list(migration.backfill_history(
+            connection, history, {'data': 'new'}, chunk_size = 2
+        ))
+        assert keys == [(1, 1), (3, 1), (4, 1)]
+
+        connection.begin()
+        with pytest.raises(ValueError):
+            migration.backfill_history(connection, history, {'data': 'x'})
+        connection.rollback()
+
+        op = Operations(MigrationContext.configure(connection))
+        op.backfill_history(
+            'mytable_history', {'data': 'resumed'}, start_after = (2, 1)
+        )
+
+    #the connection was closed without committing
+    with engine.connect() as connection:
+        data = connection.execute(
+            select(history.c.data).order_by(history.c.id)
+        ).scalars().all()
+        assert data == ['new', 'new', 'new', 'resumed', 'resumed']
+
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_verify_history(tmp_path, base):
+    '''Tests the partitioned integrity verifier against an SQLite file with a
+    version gap, a stale live version and an orphaned child history row, that
+    sparse keys are partitioned by row count and that a run can be resumed
+    from the partitions already reported.
+    '''
+
+    Base = base
+
+    class Animal(Base, ht.Versioned):
+        __tablename__ = 'animal'
+
+        id = Column(Integer, primary_key = True)
+        kind = Column(String)
+        name = Column(String)
+
+        __mapper_args__ = {
+            'polymorphic_on': kind,
+            'polymorphic_identity': 'animal',
+        }
+
+    class Dog(Animal):
+        __tablename__ = 'dog'
+
+        id = Column(Integer, ForeignKey('animal.id'), primary_key = True)
+        bark = Column(String)
+
+        __mapper_args__ = {'polymorphic_identity': 'dog'}
+
+    url = 'sqlite:///%s' % (tmp_path / 'history.sqlite')
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+
+    session = Session(bind = engine)
+    ht.version_session(session)
+
+    animals = [Dog(name = 'dog %d' % i, bark = 'woof') for i in range(1, 21)]
+    session.add_all(animals)
+    session.commit()
+
+    for version in range(3):
+        for animal in animals:
+            animal.name = '%s v%d' % (animal.name, version)
+            animal.bark = 'woof v%d' % version
+        session.commit()
+
+    session.close()
+
+    with engine.begin() as connection:
+        connection.execute(text(
+            "DELETE FROM animal_history WHERE id = 3 AND version = 2"
+        ))
+        connection.execute(text(
+            "UPDATE animal SET version = 9 WHERE id = 12"
+        ))
+
+    #a far away key doesn't multiply the number of partitions
+    session = Session(bind = engine)
+    session.add(Dog(id = 10 ** 12, name = 'far', bark = 'woof'))
+    session.commit()
+    session.close()
+
+    reports = list(verify.verify_history(
+        url, [Animal, Dog], partition_size = 5, workers = 2
+    ))
+
+    #each model's partitions are contiguous and cover the whole key space
+    for model in ('Animal', 'Dog'):
+        ranges = sorted(
+            ((r.lo, r.hi) for r in reports if r.model == model),
+            key = lambda r: (r[0] is not None, r[0]),
+        )
+        assert ranges[0][0] is None and ranges[-1][1] is None
+        assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+        assert len(ranges) < 20
+
+    violations = sorted(
+        (v.check, v.model, v.key) for r in reports for v in r.violations
+    )
+    assert violations == [
+        ('live_version', 'Animal', 12),
+        ('missing_parent', 'Dog', 3),
+        ('version_gap', 'Animal', 3),
+    ]
+
+    completed = [r for r in reports if r.hi is not None and r.hi < 10]
+    resumed = list(verify.verify_history(
+        url, [Animal, Dog], partition_size = 5, workers = 0,
+        completed = completed,
+    ))
+
+    done_to = {r.model: r.hi for r in sorted(completed, key = lambda r: r.hi)}
+    assert all(r.lo is not None and r.lo >= done_to[r.model] for r in resumed)
+    assert len(completed) + len(resumed) == len(reports)
+    assert [v.key for r in resumed for v in r.violations] == [12]
+
+    class Tag(Base, ht.Versioned):
+        __tablename__ = 'tag'
+
+        name = Column(String, primary_key = True)
+
+    with pytest.raises(ValueError):
+        list(verify.verify_history(url, [Tag], workers = 0))
+
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_load_asof(db_versioned_session, engine, base):
+    '''Tests that an object graph is loaded as it was at a point in time, with
+    a single history query and live query per relationship level, without
+    touching the instances in the caller's session.
+    '''
+
+    session = db_versioned_session
+    Base = base
+
+    class Customer(Base, ht.Versioned):
+        __tablename__ = 'customer'
+
+        id = Column(Integer, primary_key = True)
+        name = Column(String)
+
+    class Order(Base, ht.Versioned):
+        __tablename__ = 'order'
+
+        id = Column(Integer, primary_key = True)
+        customer_id = Column(Integer, ForeignKey(Customer.id))
+        customer = relationship(Customer)
+
+    class Line(Base, ht.Versioned):
+        __tablename__ = 'line'
+
+        id = Column(Integer, primary_key = True)
+        order_id = Column(Integer, ForeignKey(Order.id))
+        item = Column(String)
+        order = relationship(Order, backref = 'lines')
+
+    Base.metadata.create_all(engine)
+
+    customer = Customer(name = 'original name')
+    orders = [Order(customer = customer) for i in range(2)]
+    for order in orders:
+        order.lines = [Line(item = 'a'), Line(item = 'b'), Line(item = 'c')]
+    session.add_all(orders)
+    session.commit()
+
+    line_a, line_b, line_c = orders[0].lines
+    line_a.item = 'a2'
+    session.commit()
+
+    time.sleep(0.01)
+    as_of = datetime.datetime.utcnow()
+    time.sleep(0.01)
+
+    customer.name = 'new name'
+    line_a.item = 'a3'
+    line_b.order = orders[1]
+    session.delete(line_c)
+    session.commit()
+
+    ids = [order.id for order in orders] + [999]
+
+    statements = []
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', count)
+
+    snapshots = asof.load_asof(
+        session, Order, ids, as_of, paths = ['lines', 'customer']
+    )
+
+    event.remove(engine, 'before_cursor_execute', count)
+
+    assert len(statements) == 6
+
+    first, second = snapshots
+    assert isinstance(first, Order.__history_mapper__.class_)
+    assert first not in session
+    assert sorted(l.item for l in first.lines) == ['a2', 'b', 'c']
+    assert sorted(l.item for l in second.lines) == ['a', 'b', 'c']
+    assert first.customer is second.customer
+    assert first.customer.name == 'original name'
+
+    #snapshots are never the caller's instances, and reflect the database
+    #rather than unflushed changes
+    LineHistory = Line.__history_mapper__.class_
+    held = session.query(LineHistory).filter_by(id = line_a.id, version = 2)
+    held = held.one()
+    customer.name = 'unflushed name'
+
+    line, = asof.load_asof(session, Line, [line_a.id], as_of)
+    assert line is not held and line.item == 'a2'
+    assert held in session
+
+    now, = asof.load_asof(
+        session, Customer, [customer.id], datetime.datetime.utcnow()
+    )
+    assert now.name == 'new name'
+    assert customer in session.dirty
+
+    orm.clear_mappers()
+    Base.metadata.drop_all(engine)
+    Base.metadata.clear()
+
+def test_tiering(base, tmp_path):
+    '''Tests archiving old history rows to per-month cold files, and that
+    the history readers union both tiers while leaving cold storage alone for
+    recent reads.
+    '''
+
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+
+    engine = create_engine('sqlite:///%s' % (tmp_path / 'history.sqlite'))
+    Base.metadata.create_all(engine)
+
+    session = Session(bind = engine)
+    ht.version_session(session)
+
+    history = MyModel.__history_mapper__.local_table
+
+    model = MyModel(data = 'v1')
+    session.add(model)
+    session.commit()
+
+    for i in range(2, 6):
+        model.data = 'v%d' % i
+        session.commit()
+
+    changed = [
+        datetime.datetime(2020, 1, 10),
+        datetime.datetime(2020, 2, 10),
+        datetime.datetime(2020, 3, 10),
+    ]
+    for version, when in enumerate(changed, 1):
+        session.execute(
+            history.update()
+            .where(history.c.version == version)
+            .values(changed = when)
+        )
+    session.commit()
+
+    connection = engine.connect()
+    before = analytics.change_statistics(connection, MyModel)
+
+    store = tiering.ColdStore(str(tmp_path / 'cold'), period = 'month')
+
+    transaction = connection.begin()
+    with pytest.raises(ValueError):
+        tiering.archive_history(
+            connection, MyModel, datetime.datetime(2020, 3, 1), store
+        )
+    transaction.rollback()
+
+    moved = tiering.archive_history(
+        connection, MyModel, datetime.datetime(2020, 3, 1), store,
+        chunk_size = 1,
+    )
+
+    assert moved == 2
+    assert session.query(MyModel.__history_mapper__.class_).count() == 2
+    assert [p[0].month for p in store.partitions(history)] == [1, 2]
+
+    rows = list(tiering.history_rows(connection, MyModel, store))
+    assert [(r.version, r.data) for r in rows] == [
+        (1, 'v1'), (2, 'v2'), (3, 'v3'), (4, 'v4')
+    ]
+    assert rows[0].changed == changed[0]
+
+    after = analytics.change_statistics(connection, MyModel, store = store)
+    assert after.rows == before.rows
+    assert after.column_changes == before.column_changes
+
+    old, = asof.load_asof(
+        session, MyModel, [model.id], datetime.datetime(2020, 1, 20),
+        store = store,
+    )
+    assert (old.version, old.data) == (2, 'v2')
+
+    #cold partitions all end before this, so the store must not be opened
+    def open_partition(path):
+        pytest.fail('cold partition %s opened' % path)
+    store.engine = open_partition
+
+    recent, = asof.load_asof(
+        session, MyModel, [model.id], datetime.datetime(2020, 3, 5),
+        store = store,
+    )
+    assert (recent.version, recent.data) == (3, 'v3')
+
+    del store.engine
+
+    #a row left in both tiers by an interrupted run is read once
+    store.write(history, [rows[2]._mapping])
+    rows = list(tiering.history_rows(connection, MyModel, store))
+    assert [r.version for r in rows] == [1, 2, 3, 4]
+
+    #archived versions only count as missing if the verifier isn't told
+    url = 'sqlite:///%s' % (tmp_path / 'history.sqlite')
+    reports = list(verify.verify_history(url, [MyModel], workers = 0))
+    assert [v.check for r in reports for v in r.violations] == ['version_gap']
+
+    reports = list(verify.verify_history(
+        url, [MyModel], workers = 2, store = store
+    ))
+    assert not any(r.violations for r in reports)
+
+    connection.close()
+    session.close()
+    store.close()
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_tiering_joined_inheritance(base, tmp_path):
+    '''Tests that archived history is verified across joined inheritance
+    tables, and that as-of loading it is rejected up front.
+    '''
+
+    Base = base
+
+    class Animal(Base, ht.Versioned):
+        __tablename__ = 'animal'
+
+        id = Column(Integer, primary_key = True)
+        kind = Column(String)
+        name = Column(String)
+
+        __mapper_args__ = {
+            'polymorphic_on': kind,
+            'polymorphic_identity': 'animal',
+        }
+
+    class Dog(Animal):
+        __tablename__ = 'dog'
+
+        id = Column(Integer, ForeignKey('animal.id'), primary_key = True)
+        bark = Column(String)
+
+        __mapper_args__ = {'polymorphic_identity': 'dog'}
+
+    url = 'sqlite:///%s' % (tmp_path / 'history.sqlite')
+    engine = create_engine(url)
+    Base.metadata.create_all(engine)
+
+    session = Session(bind = engine)
+    ht.version_session(session)
+
+    dog = Dog(name = 'rex', bark = 'woof')
+    session.add(dog)
+    session.commit()
+
+    for i in range(3):
+        dog.bark = 'woof %d' % i
+        session.commit()
+
+    store = tiering.ColdStore(str(tmp_path / 'cold'))
+    cutoff = datetime.datetime.utcnow() + datetime.timedelta(days = 1)
+
+    #parents first, so that child history rows lose their parent rows
+    with engine.connect() as connection:
+        assert tiering.archive_history(connection, Animal, cutoff, store) == 3
+
+    reports = list(verify.verify_history(url, [Animal, Dog], workers = 0))
+    assert sorted(v.check for r in reports for v in r.violations) == [
+        'live_version', 'missing_parent', 'missing_parent', 'missing_parent'
+    ]
+
+    reports = list(verify.verify_history(
+        url, [Animal, Dog], workers = 0, store = store
+    ))
+    assert not any(r.violations for r in reports)
+
+    with pytest.raises(ValueError):
+        asof.load_asof(session, Dog, [dog.id], cutoff, store = store)
+
+    session.close()
+    store.close()
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_tiering_string_keys(base, tmp_path):
+    '''Tests that tiered storage refuses string primary keys, whose database
+    order may not match the Python order used to merge the tiers.
+    '''
+
+    Base = base
+
+    class Tag(Base, ht.Versioned):
+        __tablename__ = 'tag'
+
+        name = Column(String, primary_key = True)
+        color = Column(String)
+
+    engine = create_engine('sqlite:///%s' % (tmp_path / 'history.sqlite'))
+    Base.metadata.create_all(engine)
+
+    store = tiering.ColdStore(str(tmp_path / 'cold'))
+    cutoff = datetime.datetime.utcnow()
+
+    with engine.connect() as connection:
+        with pytest.raises(ValueError):
+            tiering.archive_history(connection, Tag, cutoff, store)
+
+        with pytest.raises(ValueError):
+            list(tiering.history_rows(connection, Tag, store))
+
+        with pytest.raises(ValueError):
+            analytics.change_statistics(connection, Tag, store = store)
+
+        assert list(tiering.history_rows(connection, Tag)) == []
+
+    store.close()
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()
+
+def test_change_notifications(tmp_path, base):
+    '''Tests that subscribers get one merged notification per committed
+    transaction, and nothing for rolled back flushes or savepoints.
+    '''
+
+    Base = base
+
+    class MyModel(Base, ht.Versioned):
+        __tablename__ = 'mytable'
+
+        id = Column(Integer, primary_key = True)
+        data = Column(String)
+        other = Column(String)
+
+    #a session of its own, as rolling back the fixture sessions' transaction
+    #also rolls back their connection's
+    engine = create_engine('sqlite:///%s' % (tmp_path / 'notify.sqlite'))
+    Base.metadata.create_all(engine)
+
+    session = Session(bind = engine)
+    ht.version_session(session)
+
+    received = []
+    threaded = []
+    ht.subscribe(received.append)
+    ht.subscribe(threaded.append, threaded = True)
+
+    model, deleted = MyModel(data = 'initial'), MyModel(data = 'initial')
+    session.add_all([model, deleted])
+    session.commit()
+
+    ids = model.id, deleted.id
+
+    #inserts aren't versioned
+    assert received == []
+
+    model.data = 'rolled back'
+    session.flush()
+    session.rollback()
+
+    assert received == []
+
+    model.data = 'changed'
+    session.flush()
+    model.other = 'changed too'
+    session.flush()
+
+    savepoint = session.begin_nested()
+    deleted.data = 'rolled back'
+    session.flush()
+    savepoint.rollback()
+
+    session.delete(deleted)
+    session.commit()
+
+    assert received == [[
+        ht.Change(MyModel, (ids[0],), 1, 3, ('data', 'other')),
+        ht.Change(MyModel, (ids[1],), 1, None, ()),
+    ]]
+
+    ht.wait_for_notifications()
+    assert threaded == received
+
+    ht.unsubscribe(received.append)
+    ht.unsubscribe(threaded.append)
+
+    model.data = 'unsubscribed'
+    session.commit()
+
+    assert len(received) == 1
+
+    session.close()
+    engine.dispose()
+    orm.clear_mappers()
+    Base.metadata.clear()